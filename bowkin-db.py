@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import argparse
 import glob
+import hashlib
+import io
+import json
 import os
 import re
 import shlex
@@ -8,8 +11,11 @@ import shutil
 import sqlite3
 import subprocess
 import sys
+import tarfile
 import tempfile
 
+import numpy
+
 import utils
 
 # ############################################################################ #
@@ -153,23 +159,17 @@ def _already_in_db(package_url):
     if not match:
         return False
 
-    with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
-        try:
-            return next(
-                conn.execute(
-                    "SELECT * FROM libcs where architecture=? and version=? and patch=?",
-                    (
-                        match.group("architecture"),
-                        match.group("version"),
-                        match.group("patch"),
-                    ),
-                )
-            )
-        except sqlite3.OperationalError:
-            # first time bootstrap, db is not created yet
-            return False
-        except StopIteration:
-            return False
+    # also look into the read-only roots, to not download libcs already available there
+    return any(
+        utils.select_libcs(
+            "where architecture=? and version=? and patch=?",
+            (
+                match.group("architecture"),
+                match.group("version"),
+                match.group("patch"),
+            ),
+        )
+    )
 
 
 def _add_ubuntu_libcs():
@@ -313,12 +313,11 @@ def extract(package_filepath):
 def rebuild():
     print(utils.make_bright("<rebuild>"))
 
+    libcs_filepaths = {}
+    symbols_counts = {}
     with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
         conn.execute("DROP TABLE IF EXISTS libcs")
-        conn.execute(
-            "CREATE TABLE libcs"
-            "(relpath text, architecture text, distro text, release text, version text, patch text, buildID text)"
-        )
+        _create_libcs_table(conn)
 
         for filepath in glob.glob(f"{utils.get_libcs_dirpath()}/**", recursive=True):
             match = re.match(
@@ -329,7 +328,7 @@ def rebuild():
                 relpath = os.path.relpath(filepath, utils.get_libcs_dirpath())
                 print(f"Importing: {utils.make_bright(relpath)}")
                 conn.execute(
-                    "INSERT INTO libcs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    "INSERT INTO libcs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                     (
                         relpath,
                         match.group("architecture"),
@@ -338,12 +337,277 @@ def rebuild():
                         match.group("version"),
                         match.group("patch"),
                         utils.extract_buildID(filepath),
+                        utils.sha256(filepath),
                     ),
                 )
+                libcs_filepaths[relpath] = filepath
+                # only count the symbols for now, keeping all their offsets in memory
+                # would not scale to big libraries
+                for symbol in utils.extract_symbols_offsets(filepath):
+                    symbols_counts[symbol] = symbols_counts.get(symbol, 0) + 1
+
+    _rebuild_symbols_index(libcs_filepaths, symbols_counts)
 
     print(utils.make_bright("</rebuild>"))
 
 
+def _create_libcs_table(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS libcs"
+        "(relpath text, architecture text, distro text, release text, version text, patch text, buildID text, sha256 text)"
+    )
+
+
+def _rebuild_symbols_index(libcs_filepaths, symbols_counts, n=256):
+    # index only the `n` symbols exported by most libcs, so that the matrix stays small
+    # enough to be compared in full at every `identify --nearest`
+    symbols = sorted(
+        symbols_counts, key=lambda symbol: (-symbols_counts[symbol], symbol)
+    )
+    symbols = sorted(symbols[:n])
+
+    relpaths = sorted(libcs_filepaths)
+    matrix = numpy.zeros((len(relpaths), len(symbols)), dtype=numpy.uint32)
+    for i, relpath in enumerate(relpaths):
+        offsets = utils.extract_symbols_offsets(libcs_filepaths[relpath], symbols)
+        matrix[i] = [offsets.get(symbol, 0) for symbol in symbols]
+    utils.save_symbols_index(relpaths, symbols, matrix)
+    print(
+        f"Indexed: {utils.make_bright(len(symbols))} symbols of {utils.make_bright(len(relpaths))} libcs"
+    )
+
+
+# ############################################################################ #
+
+
+def export_snapshot(snapshot_filepath, since_snapshot_filepath=None, binaries=False):
+    print(utils.make_bright("<export>"))
+
+    with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
+        conn.row_factory = sqlite3.Row
+        try:
+            libcs = {
+                libc["relpath"]: dict(libc)
+                for libc in conn.execute("SELECT * FROM libcs")
+            }
+        except sqlite3.OperationalError:
+            utils.abort("The database is missing or outdated, rebuild it first.")
+    if any(libc.get("sha256") is None for libc in libcs.values()):
+        utils.abort("The database is missing or outdated, rebuild it first.")
+    state = {relpath: libc["sha256"] for relpath, libc in libcs.items()}
+
+    # a delta carries only the libcs added or changed since the previous snapshot
+    base_id, base_state = None, {}
+    if since_snapshot_filepath:
+        with tarfile.open(since_snapshot_filepath) as tar:
+            base_manifest = _read_manifest(tar)
+        base_id, base_state = base_manifest["id"], base_manifest["libcs"]
+    added = sorted(
+        relpath for relpath in state if state[relpath] != base_state.get(relpath)
+    )
+    removed = sorted(relpath for relpath in base_state if relpath not in state)
+
+    # the symbols indexed change with the libcs in the library, so even deltas carry the
+    # whole index (it is small anyway)
+    try:
+        with open(utils.get_libcs_symbols_filepath(), "rb") as f:
+            index_data = f.read()
+        with numpy.load(io.BytesIO(index_data)) as index:
+            relpaths = set(index["relpaths"])
+    except FileNotFoundError:
+        utils.abort("The symbols index does not exist, rebuild the database first.")
+    if relpaths != set(state):
+        utils.abort("The symbols index is outdated, rebuild the database first.")
+
+    files = {}
+    if binaries:
+        for relpath in added:
+            for file_relpath in _get_libc_files_relpaths(relpath):
+                filepath = os.path.join(utils.get_libcs_dirpath(), file_relpath)
+                if os.path.isfile(filepath):
+                    files[file_relpath] = utils.sha256(filepath)
+            if files.get(relpath, libcs[relpath]["sha256"]) != libcs[relpath]["sha256"]:
+                utils.abort(
+                    f"The libc {relpath} changed since the last rebuild, rebuild the database first."
+                )
+
+    manifest = {
+        "id": _get_state_id(state),
+        "base": base_id,
+        "libcs": state,
+        "added": [libcs[relpath] for relpath in added],
+        "removed": removed,
+        "files": files,
+    }
+    with tarfile.open(snapshot_filepath, "w:gz") as tar:
+        _add_bytes(tar, "manifest.json", json.dumps(manifest, indent=4).encode())
+        _add_bytes(tar, "libcs.npz", index_data)
+        for file_relpath in files:
+            tar.add(
+                os.path.join(utils.get_libcs_dirpath(), file_relpath),
+                arcname=os.path.join("libcs", file_relpath),
+            )
+
+    print(
+        f"Exported: {utils.make_bright(len(added))} added and {utils.make_bright(len(removed))} removed libcs"
+        f" ({utils.make_bright(len(files))} files) to {utils.make_bright(snapshot_filepath)}"
+    )
+
+    print(utils.make_bright("</export>"))
+
+
+def import_snapshot(snapshot_filepath):
+    print(utils.make_bright("<import>"))
+
+    libcs_dirpath = utils.get_libcs_dirpath()
+    os.makedirs(libcs_dirpath, exist_ok=True)
+    with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
+        _create_libcs_table(conn)
+        try:
+            state = dict(conn.execute("SELECT relpath, sha256 FROM libcs"))
+        except sqlite3.OperationalError:
+            utils.abort("The database is outdated, rebuild it first.")
+
+    with tarfile.open(snapshot_filepath) as tar, tempfile.TemporaryDirectory(
+        dir=libcs_dirpath
+    ) as tmp_dirpath:
+        manifest = _read_manifest(tar)
+        added = [libc["relpath"] for libc in manifest["added"]]
+        replaced = manifest["removed"] + added
+
+        # a full snapshot can only be imported into an empty library, and a delta only
+        # on top of the snapshot it was exported from; either way, the import must
+        # result in the state of the library the snapshot was exported from
+        if manifest["base"] is None and state:
+            utils.abort(
+                "The local library is not empty, a full snapshot can only be imported into an empty library."
+            )
+        if manifest["base"] is not None and manifest["base"] != _get_state_id(state):
+            utils.abort(
+                "The local library does not match the snapshot this delta is based on."
+            )
+        new_state = {
+            relpath: sha256
+            for relpath, sha256 in state.items()
+            if relpath not in replaced
+        }
+        new_state.update(
+            {libc["relpath"]: libc["sha256"] for libc in manifest["added"]}
+        )
+        if manifest["id"] != _get_state_id(new_state):
+            utils.abort("The snapshot is inconsistent with its own state.")
+
+        # verify everything before touching the local library
+        for file_relpath, file_sha256 in manifest["files"].items():
+            _get_imported_filepath(file_relpath)
+            if file_relpath in new_state and new_state[file_relpath] != file_sha256:
+                utils.abort(f"Hash mismatch in the snapshot: {file_relpath}")
+            tmp_filepath = os.path.join(tmp_dirpath, "new", file_relpath)
+            os.makedirs(os.path.dirname(tmp_filepath), exist_ok=True)
+            _extract_member(tar, os.path.join("libcs", file_relpath), tmp_filepath)
+            if utils.sha256(tmp_filepath) != file_sha256:
+                utils.abort(f"Hash mismatch in the snapshot: {file_relpath}")
+        tmp_index_filepath = os.path.join(tmp_dirpath, "libcs.npz")
+        _extract_member(tar, "libcs.npz", tmp_index_filepath)
+        with numpy.load(tmp_index_filepath) as index:
+            if set(index["relpaths"]) != set(new_state):
+                utils.abort("The symbols index of the snapshot is inconsistent.")
+
+        # move the old files aside until the database is committed, so that they can be
+        # put back if anything fails
+        files_relpaths = set(manifest["files"])
+        for relpath in replaced:
+            files_relpaths.update(_get_libc_files_relpaths(relpath))
+        moved_aside, moved_in = [], []
+        try:
+            for file_relpath in sorted(files_relpaths):
+                filepath = _get_imported_filepath(file_relpath)
+                if os.path.isfile(filepath):
+                    old_filepath = os.path.join(tmp_dirpath, "old", file_relpath)
+                    os.makedirs(os.path.dirname(old_filepath), exist_ok=True)
+                    os.replace(filepath, old_filepath)
+                    moved_aside.append((filepath, old_filepath))
+            for file_relpath in manifest["files"]:
+                filepath = _get_imported_filepath(file_relpath)
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                os.replace(os.path.join(tmp_dirpath, "new", file_relpath), filepath)
+                moved_in.append(filepath)
+
+            with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
+                for relpath in replaced:
+                    conn.execute("DELETE FROM libcs where relpath=?", (relpath,))
+                for libc in manifest["added"]:
+                    conn.execute(
+                        "INSERT INTO libcs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            libc["relpath"],
+                            libc["architecture"],
+                            libc["distro"],
+                            libc["release"],
+                            libc["version"],
+                            libc["patch"],
+                            libc["buildID"],
+                            libc["sha256"],
+                        ),
+                    )
+        except BaseException:
+            for filepath in moved_in:
+                os.remove(filepath)
+            for filepath, old_filepath in moved_aside:
+                os.replace(old_filepath, filepath)
+            raise
+        os.replace(tmp_index_filepath, utils.get_libcs_symbols_filepath())
+
+    for relpath in manifest["removed"]:
+        print(f"Removed: {utils.make_bright(relpath)}")
+    for relpath in added:
+        print(f"Imported: {utils.make_bright(relpath)}")
+
+    print(utils.make_bright("</import>"))
+
+
+def _extract_member(tar, name, filepath):
+    try:
+        src = tar.extractfile(name)
+    except KeyError:
+        utils.abort(f"Missing from the snapshot: {name}")
+    with src, open(filepath, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+
+
+def _get_imported_filepath(relpath):
+    libcs_dirpath = utils.get_libcs_dirpath()
+    filepath = os.path.realpath(os.path.join(libcs_dirpath, relpath))
+    if os.path.commonpath((filepath, libcs_dirpath)) != libcs_dirpath:
+        utils.abort(f"Invalid path in the snapshot: {relpath}")
+    return filepath
+
+
+def _get_libc_files_relpaths(relpath):
+    # the libc, its dynamic loader and its debug symbols
+    dirpath, filename = os.path.split(relpath)
+    return (
+        relpath,
+        os.path.join(dirpath, filename.replace("libc-", "ld-", 1)),
+        f"{relpath}.debug",
+    )
+
+
+def _get_state_id(state):
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def _read_manifest(tar):
+    with tar.extractfile("manifest.json") as f:
+        return json.load(f)
+
+
+def _add_bytes(tar, name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
 # ############################################################################ #
 
 if __name__ == "__main__":
@@ -367,6 +631,28 @@ if __name__ == "__main__":
     )
     extract_parser.add_argument("package", type=argparse.FileType())
 
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Export the local library (database and symbols index) into a snapshot",
+    )
+    export_parser.add_argument("snapshot")
+    export_parser.add_argument(
+        "--since",
+        type=argparse.FileType(),
+        metavar="SNAPSHOT",
+        help="Export only the libcs added or removed since a previous snapshot",
+    )
+    export_parser.add_argument(
+        "--binaries",
+        action="store_true",
+        help="Also export the libcs, dynamic loaders and debug symbols",
+    )
+
+    import_parser = subparsers.add_parser(
+        "import", help="Import a snapshot (or a delta) into the local library"
+    )
+    import_parser.add_argument("snapshot", type=argparse.FileType())
+
     rebuild_parser = subparsers.add_parser(
         "rebuild", help="Rebuild the libcs database by rescanning the local library"
     )
@@ -383,6 +669,12 @@ if __name__ == "__main__":
         rebuild()
     elif args.action == "extract":
         extract(args.package.name)
+    elif args.action == "export":
+        export_snapshot(
+            args.snapshot, args.since.name if args.since else None, args.binaries
+        )
+    elif args.action == "import":
+        import_snapshot(args.snapshot.name)
     elif args.action == "rebuild":
         rebuild()
     else:
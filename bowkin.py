@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import filecmp
+import hashlib
 import json
 import os
 import re
 import shlex
 import shutil
-import sqlite3
 import subprocess
 import sys
+import time
 
+import elftools.common.exceptions
 import elftools.elf.elffile
+import numpy
 
 import utils
 
@@ -17,7 +22,7 @@ import utils
 def dump(libc_filepath, symbols):
     print(utils.make_bright("<dump>"))
 
-    with open(libc_filepath, "rb") as f:
+    with open(utils.fetch(libc_filepath), "rb") as f:
         elf = elftools.elf.elffile.ELFFile(f)
         dynsym_section = elf.get_section_by_name(".dynsym")
         for symbol in symbols:
@@ -36,43 +41,35 @@ def find(symbols):
     print(utils.make_bright("<find>"))
 
     matches = []
-    with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
-        conn.row_factory = sqlite3.Row
-        for libc in conn.execute("SELECT * FROM libcs"):
-            libc_filepath = os.path.join(utils.get_libcs_dirpath(), libc["relpath"])
-            with open(libc_filepath, "rb") as f:
-                elf = elftools.elf.elffile.ELFFile(f)
-                dynsym_section = elf.get_section_by_name(".dynsym")
-                for symbol, address in symbols:
-                    offset = address & 0xFFF
-                    try:
-                        libc_symbol = dynsym_section.get_symbol_by_name(symbol)[0]
-                        libc_offset = libc_symbol.entry.st_value & 0xFFF
-                        if libc_offset != offset:
-                            break
-                    except (IndexError, TypeError):
+    for libc in utils.select_libcs():
+        with open(utils.get_libc_filepath(libc), "rb") as f:
+            elf = elftools.elf.elffile.ELFFile(f)
+            dynsym_section = elf.get_section_by_name(".dynsym")
+            for symbol, address in symbols:
+                offset = address & 0xFFF
+                try:
+                    libc_symbol = dynsym_section.get_symbol_by_name(symbol)[0]
+                    libc_offset = libc_symbol.entry.st_value & 0xFFF
+                    if libc_offset != offset:
                         break
-                else:
-                    utils.dump(dict(libc))
-                    matches.append(dict(libc))
+                except (IndexError, TypeError):
+                    break
+            else:
+                utils.dump(libc)
+                matches.append(libc)
 
     print(utils.make_bright("</find>"))
     return matches
 
 
-def identify(libc_filepath):
+def identify(libc_filepath, nearest=None):
     print(utils.make_bright("<identify>"))
 
-    matches = []
-    with sqlite3.connect(utils.get_libcs_db_filepath()) as conn:
-        conn.row_factory = sqlite3.Row
-        matches = [
-            dict(libc)
-            for libc in conn.execute(
-                "SELECT * FROM libcs where buildID=?",
-                (utils.extract_buildID(libc_filepath),),
-            )
-        ]
+    matches = list(
+        utils.select_libcs("where buildID=?", (utils.extract_buildID(libc_filepath),))
+    )
+    if not matches and nearest:
+        matches = _identify_nearest(libc_filepath, nearest)
 
     for libc in matches:
         utils.dump(libc)
@@ -81,6 +78,58 @@ def identify(libc_filepath):
     return matches
 
 
+def _identify_nearest(libc_filepath, k):
+    try:
+        relpaths, symbols, offsets = utils.load_symbols_index()
+    except FileNotFoundError:
+        utils.abort("The symbols index does not exist, rebuild the database first.")
+
+    try:
+        supplied_offsets = utils.extract_symbols_offsets(libc_filepath)
+    except (elftools.common.exceptions.ELFError, AttributeError):
+        # not an ELF, or an ELF without dynamic symbols
+        utils.abort("The supplied libc does not export any symbol.")
+    query = numpy.array(
+        [supplied_offsets.get(symbol, 0) for symbol in symbols], dtype=numpy.int64
+    )
+
+    # two builds of the same sources usually differ by a constant shift of (most of)
+    # the offsets, so score each libc by the largest group of common symbols sharing the
+    # same shift, over the number of symbols exported by either of the two libcs
+    defined = offsets != 0
+    common = defined & (query != 0)
+    shifts = numpy.where(
+        common,
+        offsets.astype(numpy.int64) - query,
+        # give the other symbols distinct values so that they never group together
+        (1 << 40) + numpy.arange(len(symbols)),
+    )
+    shifts.sort(axis=1)
+    same = shifts[:, 1:] == shifts[:, :-1]
+    runs = numpy.cumsum(same, axis=1)
+    runs -= numpy.maximum.accumulate(numpy.where(same, 0, runs), axis=1)
+    largest_group = numpy.where(common.any(axis=1), runs.max(axis=1, initial=0) + 1, 0)
+    union = (defined | (query != 0)).sum(axis=1)
+    similarities = largest_group / numpy.maximum(union, 1)
+
+    # libcs with nothing in common with the supplied one are not near at all
+    candidates = numpy.flatnonzero(similarities)
+    k = min(k, len(candidates))
+    nearest = (
+        candidates[numpy.argpartition(-similarities[candidates], k - 1)[:k]]
+        if k
+        else []
+    )
+    nearest = sorted(nearest, key=lambda i: -similarities[i])
+
+    matches = []
+    for i in nearest:
+        for libc in utils.select_libcs("where relpath=?", (str(relpaths[i]),)):
+            libc["similarity"] = round(float(similarities[i]), 4)
+            matches.append(libc)
+    return matches
+
+
 def patch(binary_filepath, supplied_libc_filepath):
     print(utils.make_bright("<patch>"))
 
@@ -93,15 +142,9 @@ def patch(binary_filepath, supplied_libc_filepath):
     # TODO pick the first for now
     libc = matches[0]
 
-    libc_filepath = os.path.join(utils.get_libcs_dirpath(), libc["relpath"])
-    libc_architecture = libc["architecture"]
-    libc_patch = libc["patch"]
-    libc_version = libc["version"]
+    libc_filepath = utils.get_libc_filepath(libc)
 
-    ld_filepath = os.path.join(
-        os.path.dirname(libc_filepath),
-        os.path.basename(libc_filepath).replace("libc-", "ld-"),
-    )
+    ld_filepath = _get_ld_filepath(libc_filepath)
     # if the dynamic loader does not exist, abort (don't care about race conditions)
     if not os.path.isfile(ld_filepath):
         utils.abort(
@@ -110,13 +153,9 @@ def patch(binary_filepath, supplied_libc_filepath):
         )
 
     # copy the dynamic loader and the libc to the directory where the binary is located
-    libs_dirpath = os.path.join(
-        binary_dirpath, "libs", libc_architecture, libc_version, libc_patch
+    libs_dirpath, ld_proper_filepath, libc_proper_filepath = _get_libs_filepaths(
+        binary_dirpath, libc
     )
-    ld_proper_filename = f"ld-{libc_version}.so"
-    ld_proper_filepath = os.path.join(libs_dirpath, ld_proper_filename)
-    libc_proper_filename = f"libc-{libc_version}.so"
-    libc_proper_filepath = os.path.join(libs_dirpath, libc_proper_filename)
     if not utils.query_yes_no(
         "Copy:\n"
         f"- {utils.make_bright(ld_filepath)}\n"
@@ -128,8 +167,8 @@ def patch(binary_filepath, supplied_libc_filepath):
     ):
         utils.abort("Aborted by user.")
     os.makedirs(libs_dirpath, exist_ok=True)
-    shutil.copy2(ld_filepath, ld_proper_filepath)
-    shutil.copy2(libc_filepath, libc_proper_filepath)
+    shutil.copy2(utils.fetch(ld_filepath), ld_proper_filepath)
+    shutil.copy2(utils.fetch(libc_filepath), libc_proper_filepath)
 
     print()
 
@@ -138,7 +177,9 @@ def patch(binary_filepath, supplied_libc_filepath):
     if os.path.isfile(libc_dbg_filepath):
         libs_debug_dirpath = os.path.join(libs_dirpath, ".debug")
 
-        libc_dbg_proper_filename = utils.get_libc_dbg_proper_filename(libc_filepath)
+        libc_dbg_proper_filename = utils.get_libc_dbg_proper_filename(
+            utils.fetch(libc_filepath)
+        )
         libc_dbg_proper_filepath = os.path.join(
             libs_debug_dirpath, libc_dbg_proper_filename
         )
@@ -150,13 +191,11 @@ def patch(binary_filepath, supplied_libc_filepath):
             "?"
         ):
             os.makedirs(libs_debug_dirpath, exist_ok=True)
-            shutil.copy2(libc_dbg_filepath, libc_dbg_proper_filepath)
+            shutil.copy2(utils.fetch(libc_dbg_filepath), libc_dbg_proper_filepath)
         print()
 
     # patch the binary to use the new dynamic loader and libc
-    patched_binary_filepath = (
-        f"{binary_filepath}-{libc_architecture}-{libc_version}-{libc_patch}"
-    )
+    patched_binary_filepath = _get_patched_binary_filepath(binary_filepath, libc)
     if not utils.query_yes_no(
         "Copy:\n"
         f"- {utils.make_bright(binary_filepath)}\n"
@@ -167,8 +206,50 @@ def patch(binary_filepath, supplied_libc_filepath):
         utils.abort("Aborted by user.")
     shutil.copy2(binary_filepath, patched_binary_filepath)
 
-    ld_basename = os.path.basename(ld_proper_filename)
-    libc_basename = os.path.basename(libc_proper_filename)
+    _patchelf(
+        patched_binary_filepath,
+        binary_dirpath,
+        ld_proper_filepath,
+        libc_proper_filepath,
+    )
+
+    print(utils.make_bright("</patch>"))
+
+
+def _get_ld_filepath(libc_filepath):
+    return os.path.join(
+        os.path.dirname(libc_filepath),
+        os.path.basename(libc_filepath).replace("libc-", "ld-"),
+    )
+
+
+def _get_libc_patch(libc):
+    # libcs added by hand may have no patch, tell them apart by their content
+    if libc["patch"]:
+        return libc["patch"]
+    return (libc.get("sha256") or utils.sha256(utils.get_libc_filepath(libc)))[:12]
+
+
+def _get_libs_filepaths(binary_dirpath, libc):
+    libs_dirpath = os.path.join(
+        binary_dirpath,
+        "libs",
+        libc["architecture"],
+        libc["version"],
+        _get_libc_patch(libc),
+    )
+    ld_proper_filepath = os.path.join(libs_dirpath, f"ld-{libc['version']}.so")
+    libc_proper_filepath = os.path.join(libs_dirpath, f"libc-{libc['version']}.so")
+    return libs_dirpath, ld_proper_filepath, libc_proper_filepath
+
+
+def _get_patched_binary_filepath(binary_filepath, libc):
+    return f"{binary_filepath}-{libc['architecture']}-{libc['version']}-{_get_libc_patch(libc)}"
+
+
+def _patchelf(
+    patched_binary_filepath, binary_dirpath, ld_proper_filepath, libc_proper_filepath
+):
     subprocess.run(
         (
             f"patchelf --set-interpreter {shlex.quote(os.path.relpath(ld_proper_filepath, binary_dirpath))} {shlex.quote(patched_binary_filepath)}"
@@ -178,7 +259,141 @@ def patch(binary_filepath, supplied_libc_filepath):
         shell=True,
     )
 
-    print(utils.make_bright("</patch>"))
+
+def matrix(
+    binary_filepath,
+    architectures=None,
+    min_version=None,
+    max_version=None,
+    timeout=5,
+    jobs=None,
+    as_json=False,
+):
+    print(utils.make_bright("<matrix>"))
+
+    libcs = [
+        libc
+        for libc in utils.select_libcs()
+        if (not architectures or libc["architecture"] in architectures)
+        and (not min_version or _parse_version(libc["version"]) >= min_version)
+        and (not max_version or _parse_version(libc["version"]) <= max_version)
+    ]
+    libcs.sort(
+        key=lambda libc: (
+            libc["architecture"],
+            _parse_version(libc["version"]),
+            libc["relpath"],
+        )
+    )
+
+    # libcs with the same architecture, version and patch share the same copies in
+    # `libs` and the same patched binary, so never run two of them at the same time
+    groups = {}
+    for libc in libcs:
+        key = (libc["architecture"], libc["version"], _get_libc_patch(libc))
+        groups.setdefault(key, []).append(libc)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = {
+            result["relpath"]: result
+            for group_results in executor.map(
+                lambda group: [
+                    _patch_and_run(binary_filepath, libc, timeout) for libc in group
+                ],
+                groups.values(),
+            )
+            for result in group_results
+        }
+    results = [results[libc["relpath"]] for libc in libcs]
+
+    if as_json:
+        print(json.dumps(results, sort_keys=True, indent=4))
+    else:
+        print(f"{'libc':<48} {'status':>8} {'time':>8}  stdout")
+        for result in results:
+            time_ = f"{result['time']:.3f}" if result["time"] is not None else "-"
+            print(
+                f"{result['relpath']:<48} {result['status']:>8} {time_:>8}  {(result['stdout_sha256'] or '-')[:16]}"
+            )
+
+    print(utils.make_bright("</matrix>"))
+    return results
+
+
+def _parse_version(version):
+    return tuple(int(n) for n in version.split("."))
+
+
+def _patch_and_run(binary_filepath, libc, timeout):
+    result = {
+        "relpath": libc["relpath"],
+        "architecture": libc["architecture"],
+        "version": libc["version"],
+        "patch": libc["patch"],
+        "status": None,
+        "stdout_sha256": None,
+        "time": None,
+    }
+
+    binary_dirpath = os.path.dirname(os.path.abspath(binary_filepath))
+    libc_filepath = utils.get_libc_filepath(libc)
+    ld_filepath = _get_ld_filepath(libc_filepath)
+    if not os.path.isfile(ld_filepath):
+        result["status"] = "no-ld"
+        return result
+
+    try:
+        # the copies in `libs` are shared by all the runs against the same libc
+        libs_dirpath, ld_proper_filepath, libc_proper_filepath = _get_libs_filepaths(
+            binary_dirpath, libc
+        )
+        os.makedirs(libs_dirpath, exist_ok=True)
+        if not os.path.isfile(ld_proper_filepath) or not filecmp.cmp(
+            utils.fetch(ld_filepath), ld_proper_filepath, shallow=False
+        ):
+            shutil.copy2(utils.fetch(ld_filepath), ld_proper_filepath)
+        libc_sha256 = libc.get("sha256") or utils.sha256(utils.fetch(libc_filepath))
+        if (
+            not os.path.isfile(libc_proper_filepath)
+            or utils.sha256(libc_proper_filepath) != libc_sha256
+        ):
+            shutil.copy2(utils.fetch(libc_filepath), libc_proper_filepath)
+
+        patched_binary_filepath = _get_patched_binary_filepath(
+            os.path.abspath(binary_filepath), libc
+        )
+        shutil.copy2(binary_filepath, patched_binary_filepath)
+        _patchelf(
+            patched_binary_filepath,
+            binary_dirpath,
+            ld_proper_filepath,
+            libc_proper_filepath,
+        )
+    except Exception:
+        # a single broken libc must not stop the runs against the others
+        result["status"] = "no-patch"
+        return result
+
+    # the interpreter is relative to the directory of the binary
+    start = time.monotonic()
+    try:
+        process = subprocess.run(
+            [patched_binary_filepath],
+            cwd=binary_dirpath,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        result["status"] = "timeout"
+    except OSError:
+        result["status"] = "no-exec"
+    else:
+        result["status"] = process.returncode
+        result["stdout_sha256"] = hashlib.sha256(process.stdout).hexdigest()
+    result["time"] = time.monotonic() - start
+    return result
 
 
 if __name__ == "__main__":
@@ -188,6 +403,24 @@ if __name__ == "__main__":
         address = int(address, 16)
         return (symbol, address)
 
+    def _parse_positive_int_type(text):
+        try:
+            value = int(text)
+        except ValueError:
+            value = 0
+        if value < 1:
+            raise argparse.ArgumentTypeError(f"{text} is not a positive integer")
+        return value
+
+    def _parse_positive_float_type(text):
+        try:
+            value = float(text)
+        except ValueError:
+            value = 0
+        if not value > 0:
+            raise argparse.ArgumentTypeError(f"{text} is not a positive number")
+        return value
+
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest="action")
 
@@ -209,6 +442,12 @@ if __name__ == "__main__":
         help="Identify an unknown libc by searching the local library for libcs with the same buildID",
     )
     identify_parser.add_argument("libc", type=argparse.FileType())
+    identify_parser.add_argument(
+        "--nearest",
+        type=_parse_positive_int_type,
+        metavar="K",
+        help="If there is no exact match, list the K libcs with the most similar symbols offsets",
+    )
 
     patch_parser = subparsers.add_parser(
         "patch", help="Patch an ELF binary to use a specific libc"
@@ -216,6 +455,31 @@ if __name__ == "__main__":
     patch_parser.add_argument("binary", type=argparse.FileType())
     patch_parser.add_argument("libc", type=argparse.FileType())
 
+    matrix_parser = subparsers.add_parser(
+        "matrix",
+        help="Patch an ELF binary to use each libc in the local library, and run the patched binaries",
+    )
+    matrix_parser.add_argument("binary", type=argparse.FileType())
+    matrix_parser.add_argument(
+        "--architecture",
+        action="append",
+        help="Use only the libcs for this architecture (can be repeated)",
+    )
+    matrix_parser.add_argument("--min-version", type=_parse_version, metavar="VERSION")
+    matrix_parser.add_argument("--max-version", type=_parse_version, metavar="VERSION")
+    matrix_parser.add_argument(
+        "--timeout",
+        type=_parse_positive_float_type,
+        default=5,
+        help="Seconds after which a patched binary is killed",
+    )
+    matrix_parser.add_argument(
+        "--jobs",
+        type=_parse_positive_int_type,
+        help="Number of patched binaries to run in parallel",
+    )
+    matrix_parser.add_argument("--json", action="store_true")
+
     args = parser.parse_args()
 
     if args.action == "dump":
@@ -223,8 +487,18 @@ if __name__ == "__main__":
     elif args.action == "find":
         find(args.symbols)
     elif args.action == "identify":
-        identify(args.libc.name)
+        identify(args.libc.name, args.nearest)
     elif args.action == "patch":
         patch(args.binary.name, args.libc.name)
+    elif args.action == "matrix":
+        matrix(
+            args.binary.name,
+            args.architecture,
+            args.min_version,
+            args.max_version,
+            args.timeout,
+            args.jobs,
+            args.json,
+        )
     else:
         parser.print_help(sys.stderr)
@@ -21,6 +21,80 @@ if ! bowkin find system=0x390 | grep "a6f6c7e17083a81da551e3764672e80c39e184d3"
     exit 1
 fi
 
+tmp_dirpath="$(mktemp -d)"
+trap 'rm -rf "$tmp_dirpath"' EXIT
+
+# a libc without build ID is identified by the offsets of its symbols
+objcopy --remove-section .note.gnu.build-id "libcs/libc-amd64-2.23-0ubuntu6.so" "$tmp_dirpath/libc.so"
+if ! bowkin identify --nearest 1 "$tmp_dirpath/libc.so" | grep '"relpath": "libc-amd64-2.23-0ubuntu6.so"' 1>/dev/null; then
+    exit 1
+fi
+
+# the library above as a read-only root, under an empty local root
+with_roots () { BOWKIN_ROOTS="$tmp_dirpath/local:$PWD" BOWKIN_CACHE="$tmp_dirpath/cache" "$@"; }
+mkdir -p "$tmp_dirpath/local/libcs"
+with_roots bowkin-db rebuild
+
+if ! with_roots bowkin identify "libcs/libc-amd64-2.23-0ubuntu6.so" | grep "a6f6c7e17083a81da551e3764672e80c39e184d3" 1>/dev/null; then
+    exit 1
+fi
+
+if ! with_roots bowkin identify --nearest 1 "$tmp_dirpath/libc.so" | grep '"relpath": "libc-amd64-2.23-0ubuntu6.so"' 1>/dev/null; then
+    exit 1
+fi
+
+if ! with_roots bowkin dump "libcs/libc-amd64-2.23-0ubuntu6.so" system | grep "0x390" 1>/dev/null; then
+    exit 1
+fi
+
+if [ "$(find "$tmp_dirpath/cache" -type f | wc -l)" -ne 1 ]; then
+    exit 1
+fi
+
+# a file replaced in the read-only root must not be served from the cache anymore
+cached_filepath="$(find "$tmp_dirpath/cache" -type f)"
+touch -d "@0" "libcs/libc-amd64-2.23-0ubuntu6.so"
+with_roots bowkin dump "libcs/libc-amd64-2.23-0ubuntu6.so" system 1>/dev/null
+if [ "$(find "$tmp_dirpath/cache" -type f)" = "$cached_filepath" ] || [ "$(find "$tmp_dirpath/cache" -type f | wc -l)" -ne 1 ]; then
+    exit 1
+fi
+
+# a snapshot imported on a fresh machine, then updated by a delta
+bowkin-db export --binaries "$tmp_dirpath/snapshot-1.tar.gz"
+for root in src node; do
+    mkdir -p "$tmp_dirpath/$root/libcs"
+    BOWKIN_ROOTS="$tmp_dirpath/$root" bowkin-db rebuild
+    BOWKIN_ROOTS="$tmp_dirpath/$root" bowkin-db import "$tmp_dirpath/snapshot-1.tar.gz"
+done
+
+if ! BOWKIN_ROOTS="$tmp_dirpath/node" bowkin identify "libcs/libc-i386-2.24-11+deb9u4.so" | grep "4531f4eef89f555e73c92aeee20122923427ee99" 1>/dev/null; then
+    exit 1
+fi
+
+rm "$tmp_dirpath/src/libcs/"*i386*
+BOWKIN_ROOTS="$tmp_dirpath/src" bowkin-db rebuild
+BOWKIN_ROOTS="$tmp_dirpath/src" bowkin-db export --binaries --since "$tmp_dirpath/snapshot-1.tar.gz" "$tmp_dirpath/snapshot-2.tar.gz"
+BOWKIN_ROOTS="$tmp_dirpath/node" bowkin-db import "$tmp_dirpath/snapshot-2.tar.gz"
+
+if BOWKIN_ROOTS="$tmp_dirpath/node" bowkin identify "libcs/libc-i386-2.24-11+deb9u4.so" | grep "4531f4eef89f555e73c92aeee20122923427ee99" 1>/dev/null; then
+    exit 1
+fi
+
+if ! BOWKIN_ROOTS="$tmp_dirpath/node" bowkin identify --nearest 1 "$tmp_dirpath/libc.so" | grep '"relpath": "libc-amd64-2.23-0ubuntu6.so"' 1>/dev/null; then
+    exit 1
+fi
+
+# a delta cannot be applied twice
+if ! BOWKIN_ROOTS="$tmp_dirpath/node" bowkin-db import "$tmp_dirpath/snapshot-2.tar.gz" | grep "does not match" 1>/dev/null; then
+    exit 1
+fi
+
+# patch and run a copy of the binary, to not leave the patched binaries in `data`
+cp data/version "$tmp_dirpath/version"
+if ! bowkin matrix "$tmp_dirpath/version" --architecture amd64 --max-version 2.23 --json | grep '"status": 0' 1>/dev/null; then
+    exit 1
+fi
+
 yes | bowkin-db bootstrap
 
 echo "All tests passed!"
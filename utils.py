@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
+import hashlib
 import json
 import os
 import re
 import shlex
+import shutil
+import sqlite3
 import subprocess
+import tempfile
 import urllib.request
 
 import colorama
 import elftools.elf.elffile
+import numpy
 
 
 def abort(message):
@@ -50,6 +55,34 @@ def get_libc_dbg_proper_filename(libc_filepath):
         return libc_dbg_filename
 
 
+def sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extract_symbols_offsets(filepath, symbols=None):
+    # map each defined function or object exported by the library (or only the ones in
+    # `symbols`) to its offset; for symbols with multiple versions, keep the first one
+    # (as `dump` and `find` do)
+    symbols = set(symbols) if symbols is not None else None
+    offsets = {}
+    with open(filepath, "rb") as f:
+        elf = elftools.elf.elffile.ELFFile(f)
+        dynsym_section = elf.get_section_by_name(".dynsym")
+        for symbol in dynsym_section.iter_symbols():
+            if (
+                symbol.name
+                and (symbols is None or symbol.name in symbols)
+                and symbol.entry.st_value
+                and symbol.entry.st_info.type in ("STT_FUNC", "STT_OBJECT")
+            ):
+                offsets.setdefault(symbol.name, symbol.entry.st_value)
+    return offsets
+
+
 def retrieve(url, dirpath=None):
     if not dirpath:
         with urllib.request.urlopen(url) as u:
@@ -65,29 +98,215 @@ def retrieve(url, dirpath=None):
 
 
 def dump(libc):
-    libc["realpath"] = os.path.realpath(
-        os.path.join(get_libcs_dirpath(), libc["relpath"])
-    )
+    libc["realpath"] = os.path.realpath(get_libc_filepath(libc))
     print(json.dumps(libc, sort_keys=True, indent=4))
 
 
 # ############################################################################ #
 
 
-def get_libcs_dirpath():
+def get_roots_dirpaths():
+    # a root is a directory containing `libcs` and `libcs.db`; by default, the only
+    # root is the directory of this script, otherwise the roots are listed in
+    # `BOWKIN_ROOTS` (e.g. `~/.bowkin:/mnt/shared/bowkin`): the first one is the local
+    # writable root, the others are read-only and are searched in order
+    roots = os.environ.get("BOWKIN_ROOTS")
+    if not roots:
+        return [os.path.dirname(os.path.realpath(__file__))]
+    return [
+        os.path.realpath(os.path.expanduser(root))
+        for root in roots.split(os.pathsep)
+        if root
+    ]
+
+
+def get_libcs_dirpath(root_dirpath=None):
     # bowkin assumes either the directory `libcs` or a symlink to it can be found
-    # in the same directory of this script
-    libcs_dirpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "libcs")
+    # in the root directory
+    libcs_dirpath = os.path.join(root_dirpath or get_roots_dirpaths()[0], "libcs")
     return os.path.realpath(libcs_dirpath)
 
 
-def get_libcs_db_filepath():
+def get_libcs_db_filepath(root_dirpath=None):
     libcs_db_filepath = os.path.join(
-        os.path.dirname(os.path.realpath(__file__)), "libcs.db"
+        root_dirpath or get_roots_dirpaths()[0], "libcs.db"
     )
     return os.path.realpath(libcs_db_filepath)
 
 
+def get_libcs_symbols_filepath(root_dirpath=None):
+    libcs_symbols_filepath = os.path.join(
+        root_dirpath or get_roots_dirpaths()[0], "libcs.npz"
+    )
+    return os.path.realpath(libcs_symbols_filepath)
+
+
+def get_libc_filepath(libc):
+    return os.path.join(get_libcs_dirpath(libc["root"]), libc["relpath"])
+
+
+def select_libcs(where="", parameters=()):
+    # merge the databases of all roots; a libc in a root shadows the libcs with the
+    # same relpath in the following roots
+    relpaths = set()
+    for root_dirpath in get_roots_dirpaths():
+        libcs_db_filepath = get_libcs_db_filepath(root_dirpath)
+        if not os.path.isfile(libcs_db_filepath):
+            continue
+        with sqlite3.connect(libcs_db_filepath) as conn:
+            conn.row_factory = sqlite3.Row
+            try:
+                libcs = conn.execute(f"SELECT * FROM libcs {where}", parameters)
+                libcs = [dict(libc) for libc in libcs]
+            except sqlite3.OperationalError:
+                # the database has not been built yet
+                continue
+        for libc in libcs:
+            if libc["relpath"] in relpaths:
+                continue
+            relpaths.add(libc["relpath"])
+            libc["root"] = root_dirpath
+            yield libc
+
+
+def load_symbols_index():
+    # the symbols index is a (libcs x symbols) matrix of offsets, built by `rebuild`;
+    # an offset of zero means the symbol is not exported by the libc. The indexes of
+    # all roots are merged by aligning their columns to the symbols of the biggest one
+    indexes = []
+    for root_dirpath in get_roots_dirpaths():
+        try:
+            with numpy.load(get_libcs_symbols_filepath(root_dirpath)) as index:
+                relpaths, symbols, offsets = (
+                    index["relpaths"],
+                    index["symbols"],
+                    index["offsets"],
+                )
+        except FileNotFoundError:
+            continue
+        # e.g. a root rebuilt while still empty
+        if len(relpaths) and len(symbols):
+            indexes.append((relpaths, symbols, offsets))
+    if not indexes:
+        raise FileNotFoundError(get_libcs_symbols_filepath())
+
+    _, symbols, _ = max(indexes, key=lambda index: len(index[0]))
+    relpaths, offsets = [], []
+    for root_relpaths, root_symbols, root_offsets in indexes:
+        root_offsets = align_symbols_offsets(root_offsets, root_symbols, symbols)
+        rows = ~numpy.isin(root_relpaths, numpy.array(relpaths, dtype=str))
+        relpaths.extend(root_relpaths[rows])
+        offsets.append(root_offsets[rows])
+    return numpy.array(relpaths, dtype=str), symbols, numpy.concatenate(offsets)
+
+
+def align_symbols_offsets(offsets, symbols, to_symbols):
+    # reorder the columns of `offsets` to follow `to_symbols`; missing symbols get zero
+    if numpy.array_equal(symbols, to_symbols):
+        return offsets
+    columns = {symbol: i for i, symbol in enumerate(symbols)}
+    columns = numpy.array(
+        [columns.get(symbol, -1) for symbol in to_symbols], dtype=numpy.intp
+    )
+    if not len(symbols):
+        return numpy.zeros((len(offsets), len(to_symbols)), dtype=numpy.uint32)
+    return numpy.where(columns >= 0, offsets[:, columns], 0).astype(numpy.uint32)
+
+
+def save_symbols_index(relpaths, symbols, offsets):
+    with open(get_libcs_symbols_filepath(), "wb") as f:
+        numpy.savez(
+            f,
+            relpaths=numpy.asarray(relpaths, dtype=str),
+            symbols=numpy.asarray(symbols, dtype=str),
+            offsets=numpy.asarray(offsets, dtype=numpy.uint32),
+        )
+
+
+# ############################################################################ #
+
+
+def get_cache_dirpath():
+    return os.path.realpath(
+        os.path.expanduser(os.environ.get("BOWKIN_CACHE", "~/.cache/bowkin"))
+    )
+
+
+def get_cache_size():
+    # in bytes, 1 GiB by default
+    return int(os.environ.get("BOWKIN_CACHE_SIZE", 1 << 30))
+
+
+def fetch(filepath):
+    # files of the read-only roots (possibly on slow network mounts) are copied into
+    # the local cache the first time they are needed, and served from there afterwards
+    filepath = os.path.realpath(filepath)
+    for root_dirpath in get_roots_dirpaths()[1:]:
+        libcs_dirpath = get_libcs_dirpath(root_dirpath)
+        if os.path.commonpath((filepath, libcs_dirpath)) == libcs_dirpath:
+            break
+    else:
+        return filepath
+
+    # a cached copy is valid only as long as the source file is not replaced, e.g. by
+    # the import of a snapshot into the shared root
+    stat = os.stat(filepath)
+    cached_dirpath = os.path.join(
+        get_cache_dirpath(),
+        hashlib.sha256(root_dirpath.encode()).hexdigest()[:16],
+        os.path.relpath(filepath, libcs_dirpath),
+    )
+    cached_filepath = os.path.join(cached_dirpath, f"{stat.st_size}-{stat.st_mtime_ns}")
+    if os.path.isfile(cached_filepath):
+        # the modification time orders the cached files from the least recently used
+        os.utime(cached_filepath)
+        return cached_filepath
+
+    os.makedirs(cached_dirpath, exist_ok=True)
+    for stale_filename in os.listdir(cached_dirpath):
+        if stale_filename.startswith(".") or stale_filename == os.path.basename(
+            cached_filepath
+        ):
+            # a copy in progress, or just completed by a concurrent fetch
+            continue
+        try:
+            os.remove(os.path.join(cached_dirpath, stale_filename))
+        except FileNotFoundError:
+            pass
+    fd, tmp_filepath = tempfile.mkstemp(dir=cached_dirpath, prefix=".")
+    os.close(fd)
+    shutil.copyfile(filepath, tmp_filepath)
+    shutil.copymode(filepath, tmp_filepath)
+    os.replace(tmp_filepath, cached_filepath)
+
+    _evict_least_recently_used(keep=cached_filepath)
+    return cached_filepath
+
+
+def _evict_least_recently_used(keep):
+    cached_files = []
+    for dirpath, _, filenames in os.walk(get_cache_dirpath()):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            cached_files.append((stat.st_mtime, stat.st_size, filepath))
+
+    cache_size = sum(size for _, size, _ in cached_files)
+    for _, size, filepath in sorted(cached_files):
+        if cache_size <= get_cache_size():
+            break
+        if filepath == keep:
+            continue
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+
 # ############################################################################ #
 
 